@@ -1,8 +1,54 @@
 import numpy as np
+import ast
+import keyword
 import json
 import datetime
 from scipy.integrate import odeint
 
+# Functions a formula may call besides params.get(...) and np.<func>(...)
+ALLOWED_FUNCTIONS = {"min", "max", "abs", "round", "pow"}
+NUMPY_FUNCTIONS = {"exp", "log", "sqrt", "tanh", "sin", "cos", "minimum", "maximum", "clip", "pi"}
+
+# Names used by the generated code itself, never available to stocks/intermediates
+RESERVED_NAMES = {"params", "t", "y", "np", "deriv", "build_deriv"} | ALLOWED_FUNCTIONS
+
+
+class _SetupHoister(ast.NodeTransformer):
+    """
+    Replace parameter-only subexpressions of a per-step formula
+    (e.g. params.get('sigma', 0.2), -0.05 * beta_param) by names
+    computed once in the per-run setup stage.
+    """
+
+    def __init__(self, dynamic_names, setup_exprs):
+        self.dynamic_names = dynamic_names
+        self.setup_exprs = setup_exprs  # source -> hoisted name
+
+    def visit(self, node):
+        if self._is_hoistable(node):
+            src = ast.unparse(node)
+            if src not in self.setup_exprs:
+                self.setup_exprs[src] = f"_setup_{len(self.setup_exprs)}"
+            return ast.Name(id=self.setup_exprs[src], ctx=ast.Load())
+        
+        # Branches of conditionals are evaluated lazily: only hoist the test
+        if isinstance(node, ast.IfExp):
+            node.test = self.visit(node.test)
+            return node
+        if isinstance(node, ast.BoolOp):
+            node.values[0] = self.visit(node.values[0])
+            return node
+        
+        return self.generic_visit(node)
+
+    def _is_hoistable(self, node):
+        if not isinstance(node, ast.expr) or isinstance(node, (ast.Name, ast.Attribute, ast.Constant)):
+            return False
+        names = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+        # Pure literals are already folded by the Python compiler
+        return bool(names - ALLOWED_FUNCTIONS) and not (names & self.dynamic_names)
+
+
 class AeroDynEngine:
     def __init__(self):
         """
@@ -57,40 +103,164 @@ class AeroDynEngine:
         self._generate_code()
         self.save_state_to_json()
 
+    def _known_names(self, before_intermediate=None):
+        """
+        Names a formula may reference: stocks, plus intermediates
+        (only those defined before `before_intermediate` if given).
+        """
+        names = set(self.model_state["stocks"])
+        for var_name in self.model_state["intermediates"]:
+            if var_name == before_intermediate:
+                break
+            names.add(var_name)
+        return names
+
+    def _check_new_name(self, name, kind):
+        """
+        Check that a new stock/intermediate name can be pasted into the
+        generated code: a plain identifier not shadowing anything else.
+        
+        Raises:
+            ValueError on invalid or clashing names
+        """
+        if not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name):
+            raise ValueError(f"Invalid {kind} name '{name}'")
+        if name in RESERVED_NAMES or name.startswith("_setup_"):
+            raise ValueError(f"{kind.capitalize()} name '{name}' is reserved")
+        if name in self.model_state["stocks"] or name in self.model_state["intermediates"] \
+                or name in self.model_state["parameters"] \
+                or any(name == f"d{stock}dt" for stock in self.model_state["stocks"]):
+            raise ValueError(f"{kind.capitalize()} name '{name}' is already used in the model")
+
+    def _parse_formula(self, formula, known_names):
+        """
+        Parse a formula and check every name it uses against the model,
+        so errors surface when the formula is added, not mid-integration.
+        
+        Returns:
+            ast.Expression of the formula
+        Raises:
+            ValueError on syntax errors or unknown names/parameters
+        """
+        try:
+            tree = ast.parse(str(formula).strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid formula '{formula}': {e.msg}")
+        
+        parameters = self.model_state["parameters"]
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Lambda, ast.NamedExpr, ast.comprehension, ast.Starred)):
+                raise ValueError(f"Unsupported construct in formula '{formula}'")
+            
+            # params.get('key', default) / params['key']
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                    and isinstance(node.func.value, ast.Name) and node.func.value.id == "params":
+                if node.keywords or len(node.args) not in (1, 2):
+                    raise ValueError(
+                        f"Invalid parameter lookup '{ast.unparse(node)}' in formula '{formula}' "
+                        f"(use params.get('<name>', default))"
+                    )
+                key = node.args[0]
+            elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "params":
+                key = node.slice
+            else:
+                key = None
+            if key is not None:
+                if not (isinstance(key, ast.Constant) and key.value in parameters):
+                    raise ValueError(
+                        f"Unknown parameter {ast.unparse(key)} in formula '{formula}' "
+                        f"(known: {', '.join(parameters)})"
+                    )
+            
+            if isinstance(node, ast.Attribute):
+                base = node.value.id if isinstance(node.value, ast.Name) else None
+                if not ((base == "np" and node.attr in NUMPY_FUNCTIONS) or (base == "params" and node.attr == "get")):
+                    raise ValueError(f"Unsupported attribute '{ast.unparse(node)}' in formula '{formula}'")
+            
+            if isinstance(node, ast.Name):
+                if node.id not in known_names and node.id not in ALLOWED_FUNCTIONS \
+                        and node.id not in ("params", "t", "np"):
+                    raise ValueError(
+                        f"Unknown name '{node.id}' in formula '{formula}' "
+                        f"(use a stock, an intermediate or params.get('...'))"
+                    )
+        
+        return tree
+
     def _generate_code(self):
         """
         Automatically generate Python code from JSON state.
         This eliminates LLM from code generation - it's purely mechanical.
-        """
-        code_lines = ["def deriv(y_dict, t, params):"]
         
-        # 1. Extract all stocks
-        code_lines.append("    # --- Stock Extraction ---")
-        for stock_name, stock_data in self.model_state["stocks"].items():
-            initial = stock_data["initial"]
-            code_lines.append(f"    {stock_name} = y_dict.get('{stock_name}', {initial})")
-        code_lines.append("")
+        The code is split in two stages:
+        - build_deriv(params): per-run setup. Intermediates depending only on
+          parameters (N, beta_param, capacity...) and parameter-only
+          subexpressions of the other formulas are computed once here.
+        - deriv(y, t): per-step RHS passed to odeint, which only evaluates
+          what depends on the stocks or on time.
+        """
+        stocks = list(self.model_state["stocks"].keys())
+        dynamic_names = set(stocks) | {"t"}
         
-        # 2. Calculate intermediates
-        code_lines.append("    # --- Intermediate Calculations ---")
+        # 1. Split intermediates between setup and step stages
+        setup_lines = []
+        step_intermediates = []
         for var_name, formula in self.model_state["intermediates"].items():
-            code_lines.append(f"    {var_name} = {formula}")
-        code_lines.append("")
+            tree = self._parse_formula(formula, self._known_names(before_intermediate=var_name))
+            used = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)}
+            if used & dynamic_names:
+                dynamic_names.add(var_name)
+                step_intermediates.append((var_name, tree))
+            else:
+                setup_lines.append(f"    {var_name} = {formula}")
+        
+        # 2. Hoist parameter-only subexpressions out of the step stage
+        setup_exprs = {}
+        hoister = _SetupHoister(dynamic_names, setup_exprs)
+        known = self._known_names()
         
-        # 3. Calculate derivatives
-        code_lines.append("    # --- Derivatives ---")
-        for stock_name, deriv_data in self.model_state["derivatives"].items():
-            formula = deriv_data["formula"]
-            desc = deriv_data.get("description", "")
+        step_lines = []
+        for var_name, tree in step_intermediates:
+            step_lines.append(f"        {var_name} = {ast.unparse(hoister.visit(tree))}")
+        
+        deriv_lines = []
+        return_items = []
+        for stock_name in stocks:
+            deriv_data = self.model_state["derivatives"].get(stock_name)
+            if deriv_data is None:
+                return_items.append("0.0")
+                continue
+            tree = self._parse_formula(deriv_data["formula"], known)
+            desc = " ".join(str(deriv_data.get("description", "")).split())
             if desc:
-                code_lines.append(f"    # {desc}")
-            code_lines.append(f"    d{stock_name}dt = {formula}")
-        code_lines.append("")
+                deriv_lines.append(f"        # {desc}")
+            deriv_lines.append(f"        d{stock_name}dt = {ast.unparse(hoister.visit(tree))}")
+            return_items.append(f"d{stock_name}dt")
+        
+        for src, name in setup_exprs.items():
+            setup_lines.append(f"    {name} = {src}")
         
-        # 4. Return dictionary
-        code_lines.append("    # --- Return ---")
-        return_items = [f"'{stock}': d{stock}dt" for stock in self.model_state["stocks"].keys()]
-        code_lines.append(f"    return {{{', '.join(return_items)}}}")
+        # 3. Assemble both stages
+        code_lines = ["def build_deriv(params):"]
+        code_lines.append("    # --- Per-run Setup (parameters only) ---")
+        code_lines.extend(setup_lines)
+        code_lines.append("")
+        code_lines.append("    def deriv(y, t):")
+        code_lines.append("        # --- Stock Extraction ---")
+        unpack = ', '.join(stocks) + (',' if len(stocks) == 1 else '')
+        code_lines.append(f"        {unpack} = y")
+        code_lines.append("")
+        if step_lines:
+            code_lines.append("        # --- Intermediate Calculations ---")
+            code_lines.extend(step_lines)
+            code_lines.append("")
+        code_lines.append("        # --- Derivatives ---")
+        code_lines.extend(deriv_lines)
+        code_lines.append("")
+        code_lines.append("        # --- Return ---")
+        code_lines.append(f"        return [{', '.join(return_items)}]")
+        code_lines.append("")
+        code_lines.append("    return deriv")
         
         self.formula_code = '\n'.join(code_lines)
         self._compile()
@@ -99,7 +269,26 @@ class AeroDynEngine:
         """Compile the generated code into executable function."""
         local_ns = {}
         exec(self.formula_code, globals(), local_ns)
-        self.deriv_func = local_ns['deriv']
+        self.build_deriv = local_ns['build_deriv']
+
+    def _regenerate(self, previous_state):
+        """
+        Regenerate code after a single edit and save it. If generation fails
+        (e.g. a formula still references a removed stock), restore
+        previous_state before re-raising.
+        """
+        try:
+            self._generate_code()
+        except Exception:
+            print("[ENGINE] Edit rejected, restoring previous model")
+            self._restore(previous_state)
+            raise
+        self.save_state_to_json()
+
+    def _restore(self, previous_state):
+        """Put back a model_state snapshot and its generated code."""
+        self.model_state = previous_state
+        self._generate_code()
 
     def add_stock(self, stock_name, initial_value=0, description="", inflow=None, outflow=None, custom_derivative=None):
         """
@@ -113,8 +302,36 @@ class AeroDynEngine:
             outflow: Expression for outflow (e.g., '0.05 * Lobbying')
             custom_derivative: Full derivative formula if not using inflow-outflow pattern
         """
+        previous_state = json.loads(json.dumps(self.model_state))  # Deep copy
+        self._add_stock_entry(stock_name, initial_value, description, inflow, outflow, custom_derivative)
+        
+        # Regenerate code from updated JSON
+        self._regenerate(previous_state)
+        
+        return True
+
+    def _add_stock_entry(self, stock_name, initial_value=0, description="", inflow=None, outflow=None, custom_derivative=None):
+        """Edit the JSON state for a new stock, without regenerating code."""
         print(f"[ENGINE] Adding stock: {stock_name}")
         
+        # Validate the name and flows before touching the state
+        self._check_new_name(stock_name, "stock")
+        if f"d{stock_name}dt" in self.model_state["intermediates"]:
+            raise ValueError(f"Stock name '{stock_name}' clashes with intermediate 'd{stock_name}dt'")
+        if inflow and outflow:
+            self._check_new_name(f"inflow_{stock_name.lower()}", "intermediate")
+            self._check_new_name(f"outflow_{stock_name.lower()}", "intermediate")
+        known = self._known_names() | {stock_name}
+        if inflow and outflow:
+            self._parse_formula(inflow, known)
+            self._parse_formula(outflow, known)
+            derivative_formula = f"max(-{stock_name}, inflow_{stock_name.lower()} - outflow_{stock_name.lower()})"
+        elif custom_derivative:
+            self._parse_formula(custom_derivative, known)
+            derivative_formula = custom_derivative
+        else:
+            raise ValueError("Must provide either (inflow, outflow) or custom_derivative")
+        
         # 1. Add to stocks
         self.model_state["stocks"][stock_name] = {
             "initial": initial_value,
@@ -125,34 +342,33 @@ class AeroDynEngine:
         if inflow and outflow:
             self.model_state["intermediates"][f"inflow_{stock_name.lower()}"] = inflow
             self.model_state["intermediates"][f"outflow_{stock_name.lower()}"] = outflow
-            
-            # 3. Add derivative with positivity guard
-            derivative_formula = f"max(-{stock_name}, inflow_{stock_name.lower()} - outflow_{stock_name.lower()})"
-        elif custom_derivative:
-            derivative_formula = custom_derivative
-        else:
-            raise ValueError("Must provide either (inflow, outflow) or custom_derivative")
         
+        # 3. Add derivative (with positivity guard for inflow-outflow)
         self.model_state["derivatives"][stock_name] = {
             "formula": derivative_formula,
             "description": description
         }
-        
-        # 4. Regenerate code from updated JSON
-        self._generate_code()
-        self.save_state_to_json()
-        
-        return True
 
     def remove_stock(self, stock_name):
         """
         Remove a stock from the model.
         """
+        previous_state = json.loads(json.dumps(self.model_state))  # Deep copy
+        self._remove_stock_entry(stock_name)
+        
+        # Regenerate code (rejected if other formulas still use the stock)
+        self._regenerate(previous_state)
+        
+        return True
+
+    def _remove_stock_entry(self, stock_name):
+        """Remove a stock and its flows from the JSON state, without regenerating code."""
         print(f"[ENGINE] Removing stock: {stock_name}")
+        if stock_name not in self.model_state["stocks"]:
+            raise ValueError(f"Unknown stock: {stock_name}")
         
         # Remove from stocks
-        if stock_name in self.model_state["stocks"]:
-            del self.model_state["stocks"][stock_name]
+        del self.model_state["stocks"][stock_name]
         
         # Remove derivative
         if stock_name in self.model_state["derivatives"]:
@@ -165,27 +381,88 @@ class AeroDynEngine:
             del self.model_state["intermediates"][inflow_key]
         if outflow_key in self.model_state["intermediates"]:
             del self.model_state["intermediates"][outflow_key]
-        
-        # Regenerate code
-        self._generate_code()
-        self.save_state_to_json()
-        
-        return True
 
     def modify_intermediate(self, var_name, new_formula):
         """Modify an intermediate calculation."""
+        previous_state = json.loads(json.dumps(self.model_state))  # Deep copy
+        self._modify_intermediate_entry(var_name, new_formula)
+        self._regenerate(previous_state)
+
+    def _modify_intermediate_entry(self, var_name, new_formula):
         print(f"[ENGINE] Modifying intermediate: {var_name}")
+        if var_name not in self.model_state["intermediates"]:
+            self._check_new_name(var_name, "intermediate")
+        self._parse_formula(new_formula, self._known_names(before_intermediate=var_name))
         self.model_state["intermediates"][var_name] = new_formula
-        self._generate_code()
-        self.save_state_to_json()
 
     def modify_derivative(self, stock_name, new_formula):
         """Modify a derivative formula."""
+        previous_state = json.loads(json.dumps(self.model_state))  # Deep copy
+        if self._modify_derivative_entry(stock_name, new_formula):
+            self._regenerate(previous_state)
+
+    def _modify_derivative_entry(self, stock_name, new_formula):
         print(f"[ENGINE] Modifying derivative for: {stock_name}")
-        if stock_name in self.model_state["derivatives"]:
-            self.model_state["derivatives"][stock_name]["formula"] = new_formula
+        if stock_name not in self.model_state["derivatives"]:
+            return False
+        self._parse_formula(new_formula, self._known_names())
+        self.model_state["derivatives"][stock_name]["formula"] = new_formula
+        return True
+
+    def apply_operations(self, operations):
+        """
+        Apply a batch of operations as a single model revision.
+        
+        All edits are made on the JSON state first, then the code is generated,
+        compiled and validated once. On success a single version is saved;
+        on failure the previous state is restored and nothing is persisted.
+        
+        Args:
+            operations: List of dicts with an "operation" key among
+                'add_stock', 'remove_stock', 'modify_intermediate', 'modify_derivative'
+        
+        Returns:
+            (success, error_message)
+        """
+        previous_state = json.loads(json.dumps(self.model_state))  # Deep copy
+        
+        try:
+            for op in operations:
+                kind = op.get("operation")
+                if kind == "add_stock":
+                    self._add_stock_entry(
+                        stock_name=op["stock_name"],
+                        initial_value=op.get("initial_value", 0),
+                        description=op.get("description", ""),
+                        inflow=op.get("inflow"),
+                        outflow=op.get("outflow"),
+                        custom_derivative=op.get("custom_derivative")
+                    )
+                elif kind == "remove_stock":
+                    self._remove_stock_entry(op["stock_name"])
+                elif kind == "modify_intermediate":
+                    self._modify_intermediate_entry(op["var_name"], op["formula"])
+                elif kind == "modify_derivative":
+                    if not self._modify_derivative_entry(op["stock_name"], op["formula"]):
+                        raise ValueError(f"Unknown stock: {op['stock_name']}")
+                else:
+                    raise ValueError(f"Unknown operation type: {kind}")
+            
+            # One generation + compile for the whole batch
             self._generate_code()
-            self.save_state_to_json()
+            
+            # One physics validation for the whole batch
+            is_stable, msg = self.validate_logic()
+            if not is_stable:
+                raise ValueError(f"Physics validation failed: {msg}")
+        
+        except Exception as e:
+            print(f"[ENGINE] Batch rejected, restoring previous model: {e}")
+            self._restore(previous_state)
+            return False, str(e)
+        
+        self.save_state_to_json()
+        return True, None
 
     def get_current_state(self):
         """Return the current model state as JSON."""
@@ -201,15 +478,11 @@ class AeroDynEngine:
             stocks = list(self.model_state["stocks"].keys())
             y0 = [self.model_state["stocks"][s]["initial"] for s in stocks]
             
-            def wrapper(y, t):
-                y_dict = dict(zip(stocks, y))
-                params = self.model_state["parameters"]
-                d = self.deriv_func(y_dict, t, params)
-                return [d.get(k, 0) for k in stocks]
+            deriv = self.build_deriv(self.model_state["parameters"])
             
             # Test simulation
             t_test = np.linspace(0, 40, 50)
-            sol = odeint(wrapper, y0, t_test)
+            sol = odeint(deriv, y0, t_test)
             
             # Check for explosions or negative values
             if np.any(np.abs(sol) > 5000):
@@ -259,17 +532,14 @@ class AeroDynEngine:
         stocks = list(self.model_state["stocks"].keys())
         y0 = [self.model_state["stocks"][s]["initial"] for s in stocks]
         
-        def safe_wrapper(y, t, p, ks):
-            y_dict = dict(zip(ks, y))
-            
-            class SafeParams(dict):
-                def __getitem__(self, k):
-                    return self.get(k, 0.0)
-            
-            res = self.deriv_func(y_dict, t, SafeParams(p))
-            return [res.get(k, 0) for k in ks]
+        class SafeParams(dict):
+            def __getitem__(self, k):
+                return self.get(k, 0.0)
+        
+        # Parameter-only terms are computed once here, not at every RHS call
+        deriv = self.build_deriv(SafeParams(params))
         
-        sol = odeint(safe_wrapper, y0, t, args=(params, stocks))
+        sol = odeint(deriv, y0, t)
         
         # Clip to prevent graph errors
         limit = params.get('S0', 100) * 2
@@ -3,6 +3,7 @@ from engine import AeroDynEngine
 import datetime
 import ollama
 import json
+import ast
 import re
 
 app = Flask(__name__)
@@ -24,33 +25,49 @@ def llm_update():
     print(f"\n[STRATEGIC LOG] User Request: {user_req}")
     
     # --- FORCE RESET ---
-    if any(word in user_req for word in ["reset", "revenir", "initial", "baseline"]):
+    # Only a bare reset prompt (e.g. "reset au modèle de base"); a compound
+    # request mentioning e.g. an "initial" value goes through the LLM batch.
+    reset_match = re.fullmatch(
+        r"\s*(?:(?:reset|revenir|retour)(?:\s+(?:au|à\s+la|à\s+l'|to(?:\s+the)?))?"
+        r"(?:\s*(?:modèle|model|version))?(?:\s+(?:de\s+base|initial|baseline|base))?"
+        r"|baseline|initial)\s*[.!]?\s*",
+        user_req
+    )
+    if reset_match:
         print("[SYSTEM] Force Resetting to Baseline...")
         engine.reset_to_baseline()
         return jsonify({"status": "success", "new_code": engine.formula_code})
 
     # --- VARIABLE REMOVAL ---
-    removal_keywords = ["supprime", "enlève", "retire", "delete", "remove"]
-    if any(word in user_req for word in removal_keywords):
+    # Shortcut only for a bare removal prompt (e.g. the frontend's
+    # "supprime la variable X"); compound requests go through the LLM batch.
+    removal_match = re.fullmatch(
+        r'\s*(?:supprime|enlève|retire|delete|remove)(?:\s+(?:la\s+variable|variable|the\s+variable))?\s+([\w]+)\s*',
+        user_req
+    )
+    if removal_match:
         base_vars = ['S', 'I', 'R', 'Rep']
         current_vars = list(engine.model_state["stocks"].keys())
         removable_vars = [v for v in current_vars if v not in base_vars]
         
         target_var = None
         for var in removable_vars:
-            if var.lower() in user_req:
+            if var.lower() == removal_match.group(1):
                 target_var = var
                 break
         
         if target_var:
             print(f"[SYSTEM] Removing variable: {target_var}")
-            engine.remove_stock(target_var)
+            success, error = engine.apply_operations([{"operation": "remove_stock", "stock_name": target_var}])
+            if not success:
+                return jsonify({"status": "error", "message": error})
             return jsonify({"status": "success", "new_code": engine.formula_code})
 
     # --- DIFF-BASED SYSTEM PROMPT ---
     system_prompt = (
         "You are a System Dynamics expert. Instead of generating full Python code, "
-        "you will provide STRUCTURED JSON instructions for adding/modifying model elements.\n\n"
+        "you will provide STRUCTURED JSON instructions for adding/modifying model elements.\n"
+        "A single request may need several operations: return them ALL in one response.\n\n"
         
         f"CURRENT MODEL STATE:\n{engine.get_current_state()}\n\n"
         
@@ -59,15 +76,26 @@ def llm_update():
         
         "```json\n"
         "{\n"
-        '  "operation": "add_stock",\n'
-        '  "stock_name": "Lobbying",\n'
-        '  "initial_value": 0,\n'
-        '  "description": "Political influence",\n'
-        '  "inflow": "0.1 * (gamma_param * I)",\n'
-        '  "outflow": "0.05 * Lobbying"\n'
+        '  "operations": [\n'
+        "    {\n"
+        '      "operation": "add_stock",\n'
+        '      "stock_name": "Lobbying",\n'
+        '      "initial_value": 0,\n'
+        '      "description": "Political influence",\n'
+        '      "inflow": "0.1 * (gamma_param * I)",\n'
+        '      "outflow": "0.05 * Lobbying"\n'
+        "    }\n"
+        "  ]\n"
         "}\n"
         "```\n\n"
         
+        "### AVAILABLE OPERATIONS ###\n"
+        '- add_stock: {"operation": "add_stock", "stock_name", "initial_value", "description", "inflow", "outflow"}\n'
+        '- modify_intermediate: {"operation": "modify_intermediate", "var_name", "formula"}\n'
+        '- modify_derivative: {"operation": "modify_derivative", "stock_name", "formula"}\n'
+        '- remove_stock: {"operation": "remove_stock", "stock_name"}\n'
+        "Operations are applied in order, so a later operation may reference a stock added earlier.\n\n"
+        
         "### CRITICAL RULES ###\n"
         "1. **STOCK NAME**: Capitalized (e.g., 'Lobbying', 'Sanctions', 'Budget')\n\n"
         
@@ -85,18 +113,26 @@ def llm_update():
         "5. **SATURATION**: Apply in inflow:\n"
         "   Example: \"inflow\": \"0.1 * (gamma_param * I) * (100 - Research) / 100\"\n\n"
         
+        "6. **NAMES**: Formulas may only use stocks, intermediates, 't', min/max/abs,\n"
+        "   and params.get('<name>', default) for the parameters listed in the model state.\n"
+        "   NEVER write a parameter bare (use params.get('beta', 0.4), not beta)\n\n"
+        
         "### EXAMPLES ###\n\n"
         
         "**Example 1: Revenue-based growth**\n"
         "User: 'ajoute lobbying alimenté par 10% des revenus avec 5% dépréciation'\n"
         "```json\n"
         "{\n"
-        '  "operation": "add_stock",\n'
-        '  "stock_name": "Lobbying",\n'
-        '  "initial_value": 0,\n'
-        '  "description": "Political lobbying influence",\n'
-        '  "inflow": "0.1 * (gamma_param * I)",\n'
-        '  "outflow": "0.05 * Lobbying"\n'
+        '  "operations": [\n'
+        "    {\n"
+        '      "operation": "add_stock",\n'
+        '      "stock_name": "Lobbying",\n'
+        '      "initial_value": 0,\n'
+        '      "description": "Political lobbying influence",\n'
+        '      "inflow": "0.1 * (gamma_param * I)",\n'
+        '      "outflow": "0.05 * Lobbying"\n'
+        "    }\n"
+        "  ]\n"
         "}\n"
         "```\n\n"
         
@@ -104,70 +140,112 @@ def llm_update():
         "User: 'ajoute sanctions activées si réputation < 40'\n"
         "```json\n"
         "{\n"
-        '  "operation": "add_stock",\n'
-        '  "stock_name": "Sanctions",\n'
-        '  "initial_value": 0,\n'
-        '  "description": "Economic sanctions level",\n'
-        '  "inflow": "0.5 if Rep < 40 else 0.0",\n'
-        '  "outflow": "0.1 * Sanctions"\n'
+        '  "operations": [\n'
+        "    {\n"
+        '      "operation": "add_stock",\n'
+        '      "stock_name": "Sanctions",\n'
+        '      "initial_value": 0,\n'
+        '      "description": "Economic sanctions level",\n'
+        '      "inflow": "0.5 if Rep < 40 else 0.0",\n'
+        '      "outflow": "0.1 * Sanctions"\n'
+        "    }\n"
+        "  ]\n"
         "}\n"
         "```\n\n"
         
-        "**Example 3: Complex calculation**\n"
-        "User: 'ajoute budget avec 15% revenus moins 10% coûts'\n"
+        "**Example 3: Compound request**\n"
+        "User: 'ajoute budget avec 15% revenus moins 10% coûts, et les sanctions réduisent la capacité de 50%'\n"
         "```json\n"
         "{\n"
-        '  "operation": "add_stock",\n'
-        '  "stock_name": "Budget",\n'
-        '  "initial_value": 0,\n'
-        '  "description": "Operational budget",\n'
-        '  "inflow": "0.15 * (gamma_param * I)",\n'
-        '  "outflow": "0.10 * Budget"\n'
+        '  "operations": [\n'
+        "    {\n"
+        '      "operation": "add_stock",\n'
+        '      "stock_name": "Budget",\n'
+        '      "initial_value": 0,\n'
+        '      "description": "Operational budget",\n'
+        '      "inflow": "0.15 * (gamma_param * I)",\n'
+        '      "outflow": "0.10 * Budget"\n'
+        "    },\n"
+        "    {\n"
+        '      "operation": "add_stock",\n'
+        '      "stock_name": "Sanctions",\n'
+        '      "initial_value": 0,\n'
+        '      "description": "Economic sanctions level",\n'
+        '      "inflow": "0.5 if Rep < 40 else 0.0",\n'
+        '      "outflow": "0.1 * Sanctions"\n'
+        "    },\n"
+        "    {\n"
+        '      "operation": "modify_intermediate",\n'
+        '      "var_name": "capacity",\n'
+        '      "formula": "params.get(\'capacity\', 40) * (0.5 if Sanctions > 1 else 1.0)"\n'
+        "    }\n"
+        "  ]\n"
         "}\n"
         "```\n\n"
         
         "### OUTPUT ###\n"
-        "Return ONLY the JSON object. No explanations, no markdown, just pure JSON."
+        "Return ONLY the JSON object with its \"operations\" list. No explanations, no markdown, just pure JSON."
     )
 
     def parse_ai_response(response_text):
         """
-        Extract JSON from AI response.
-        Handles markdown code blocks and extra text.
+        Extract the list of operations from AI response.
+        Handles markdown code blocks and extra text, and accepts either
+        {"operations": [...]}, a bare list, or a single operation object.
         """
         # Remove markdown code blocks
         clean = response_text.strip()
         clean = re.sub(r'```json\s*', '', clean)
         clean = re.sub(r'```\s*', '', clean)
         
-        # Try to extract JSON object
-        json_match = re.search(r'\{[^}]*\}', clean, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
+        # Scan each '{' / '[' and decode the first JSON value holding operations
+        decoder = json.JSONDecoder()
+        for match in re.finditer(r'[\[{]', clean):
             try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as e:
-                print(f"[PARSE ERROR] Invalid JSON: {e}")
-                return None
+                data, _ = decoder.raw_decode(clean, match.start())
+            except json.JSONDecodeError:
+                continue
+            
+            if isinstance(data, dict) and isinstance(data.get("operations"), list):
+                data = data["operations"]
+            elif isinstance(data, dict):
+                data = [data]
+            
+            if data and isinstance(data, list) and all(isinstance(op, dict) for op in data):
+                return data
         
+        print("[PARSE ERROR] No valid JSON operations found")
         return None
 
     def validate_and_fix_operation(operation):
         if not operation or "operation" not in operation:
             return None, "Missing 'operation' field"
         
+        kind = operation["operation"]
+        if kind == "modify_intermediate":
+            if not operation.get("var_name") or not operation.get("formula"):
+                return None, "modify_intermediate requires 'var_name' and 'formula'"
+            return operation, None
+        if kind == "modify_derivative":
+            if not operation.get("stock_name") or not operation.get("formula"):
+                return None, "modify_derivative requires 'stock_name' and 'formula'"
+            return operation, None
+        if kind == "remove_stock":
+            if not operation.get("stock_name"):
+                return None, "remove_stock requires 'stock_name'"
+            if str(operation["stock_name"]).strip().lower() in ['s', 'i', 'r', 'rep']:
+                return None, f"Cannot remove base stock {operation['stock_name']}"
+            return operation, None
+        if kind != "add_stock":
+            return None, f"Unknown operation type: {kind}"
+        
         # 1. Normalisation du Nom (Strict)
         original_name = operation.get("stock_name", "")
         # On capitalise uniquement la première lettre, le reste en minuscule
         stock_name = original_name.strip().capitalize() 
         operation["stock_name"] = stock_name
         
-        # 2. AUTO-FIX: Remplacement de la casse dans les formules
-        # Cela évite l'erreur "not defined" si l'IA mélange FrictionAdministrative et Frictionadministrative
-        for field in ["inflow", "outflow"]:
-            if field in operation:
-                # On remplace l'ancien nom par le nouveau dans la formule
-                operation[field] = re.sub(rf'\b{original_name}\b', stock_name, operation[field], flags=re.IGNORECASE)
+        # 2. La casse dans les formules est corrigée pour tout le lot (normalize_stock_names)
 
         # 3. AUTO-FIX: Remplacement de R par le flux (gamma_param * I)
         inflow = operation.get("inflow", "")
@@ -182,89 +260,131 @@ def llm_update():
             coeff_match = re.search(r'0\.\d+', outflow)
             coeff = coeff_match.group(0) if coeff_match else "0.1"
             operation["outflow"] = f"{coeff} * {stock_name}"
+        
+        operation.setdefault("initial_value", 0)
+        operation.setdefault("description", "")
             
         return operation, None
 
-    def apply_operation(operation):
+    def rename_in_formula(formula, original_name, stock_name):
         """
-        Apply the validated operation to the engine.
+        Rename variable references to a stock inside a formula, matching
+        case-insensitively (the AI mixes FrictionAdministrative and
+        Frictionadministrative). Works on the AST so string constants such
+        as params.get('capacity', 40) are left untouched.
         """
         try:
-            if operation["operation"] == "add_stock":
-                engine.add_stock(
-                    stock_name=operation["stock_name"],
-                    initial_value=operation["initial_value"],
-                    description=operation["description"],
-                    inflow=operation["inflow"],
-                    outflow=operation["outflow"]
-                )
-                
-                # Validate physics
-                is_stable, msg = engine.validate_logic()
-                if not is_stable:
-                    return False, f"Physics validation failed: {msg}"
-                
-                return True, None
-            
-            return False, "Unknown operation type"
+            tree = ast.parse(formula.strip(), mode="eval")
+        except SyntaxError:
+            return formula  # Reported by the engine when the formula is added
+        
+        existing = set(engine.model_state["stocks"]) | set(engine.model_state["intermediates"])
+        changed = False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id != stock_name \
+                    and node.id.lower() == original_name.lower() and node.id not in existing:
+                node.id = stock_name
+                changed = True
+        
+        return ast.unparse(tree) if changed else formula
+
+    def normalize_stock_names(operations):
+        """
+        Propagate the add_stock name normalisation (capitalize) to every
+        operation of the batch, so later operations referring to the
+        original name (e.g. MarketShare -> Marketshare) still resolve.
+        """
+        renames = {}
+        for operation in operations:
+            if operation.get("operation") == "add_stock":
+                original_name = str(operation.get("stock_name", "")).strip()
+                if original_name:
+                    renames[original_name] = original_name.capitalize()
+        
+        for original_name, stock_name in renames.items():
+            for operation in operations:
+                if str(operation.get("stock_name", "")).strip().lower() == original_name.lower():
+                    operation["stock_name"] = stock_name
+                for field in ["inflow", "outflow", "formula", "custom_derivative"]:
+                    if isinstance(operation.get(field), str):
+                        operation[field] = rename_in_formula(operation[field], original_name, stock_name)
+        
+        return operations
+
+    def apply_operations(operations):
+        """
+        Apply the validated operations to the engine as a single batch
+        (one compile, one physics validation, one saved version).
+        """
+        try:
+            success, error = engine.apply_operations(operations)
+            if not success:
+                return False, f"Operation failed: {error}"
+            return True, None
             
         except Exception as e:
             return False, f"Operation failed: {str(e)}"
 
-    def get_ai_operation(prompt):
+    def get_ai_operations(prompt):
         """
-        Get structured JSON operation from AI.
+        Get the list of structured JSON operations from AI in one call.
         """
-        print(f"[OLLAMA] Requesting JSON operation...")
+        print(f"[OLLAMA] Requesting JSON operations...")
         
         resp = ollama.generate(model='qwen2.5-coder:7b', system=system_prompt, prompt=prompt)
         raw_text = resp['response'].strip()
         
         print(f"[OLLAMA] Raw response:\n{raw_text}\n")
         
-        operation = parse_ai_response(raw_text)
-        if not operation:
+        operations = parse_ai_response(raw_text)
+        if not operations:
             print("[PARSE] Failed to extract JSON")
             return None
         
-        print(f"[PARSE] Extracted operation: {json.dumps(operation, indent=2)}")
+        print(f"[PARSE] Extracted operations: {json.dumps(operations, indent=2)}")
         
-        # Validate and auto-fix
-        fixed_op, error = validate_and_fix_operation(operation)
-        if error:
-            print(f"[VALIDATION] Error: {error}")
-            return None
+        # Same stock names across the whole batch
+        normalize_stock_names(operations)
+        
+        # Validate and auto-fix each operation
+        fixed_ops = []
+        for operation in operations:
+            fixed_op, error = validate_and_fix_operation(operation)
+            if error:
+                print(f"[VALIDATION] Error: {error}")
+                return None
+            fixed_ops.append(fixed_op)
         
-        print(f"[VALIDATION] ✓ Operation validated")
-        return fixed_op
+        print(f"[VALIDATION] ✓ {len(fixed_ops)} operation(s) validated")
+        return fixed_ops
 
     try:
         # Attempt 1
-        operation = get_ai_operation(f"User request: {user_req}")
+        operations = get_ai_operations(f"User request: {user_req}")
         
-        if not operation:
+        if not operations:
             print("[OLLAMA] First attempt failed, retrying with clarification...")
             
             # Attempt 2: More explicit
             clarification = (
                 f"User request: {user_req}\n\n"
-                f"Generate a JSON operation to add a new stock variable.\n"
+                f"Generate a JSON object with an \"operations\" list covering the whole request.\n"
                 f"CRITICAL: Use 'gamma_param * I' for revenue flow, NOT 'R'.\n"
                 f"Return ONLY valid JSON, no other text."
             )
             
-            operation = get_ai_operation(clarification)
+            operations = get_ai_operations(clarification)
             
-            if not operation:
+            if not operations:
                 return jsonify({
                     "status": "error",
-                    "message": "AI failed to generate valid JSON operation"
+                    "message": "AI failed to generate valid JSON operations"
                 })
         
-        print(f"[OPERATION] Applying: {json.dumps(operation, indent=2)}")
+        print(f"[OPERATION] Applying {len(operations)} operation(s): {json.dumps(operations, indent=2)}")
         
-        # Apply the operation
-        success, error = apply_operation(operation)
+        # Apply all operations as one batch
+        success, error = apply_operations(operations)
         
         if not success:
             print(f"[ENGINE] Operation failed: {error}")
@@ -276,7 +396,7 @@ def llm_update():
         return jsonify({
             "status": "success",
             "new_code": engine.formula_code,
-            "operation": operation
+            "operations": operations
         })
         
     except Exception as e: